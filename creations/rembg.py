@@ -6,9 +6,18 @@ import urllib.parse
 import websocket # NOTE: needs websocket-client library
 import io
 import os
+import math
+import threading
+import functools
+import hashlib
 import base64
+import time
+import zipfile
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response
 from flask_cors import CORS
 from datetime import datetime
 import requests # Need this for multipart upload
@@ -21,6 +30,71 @@ RMBG_INPUT_NODE_ID = "3"
 # The IDs of the PreviewImage nodes in the RMBG workflow
 RMBG_OUTPUT_NODE_IDS = ["20", "26", "27"] # Corresponds to RMBG-2.0, INSPYRENET, BEN outputs via PreviewImage
 
+# --- Admission Control (per-client token bucket + concurrency cap) ---
+# Checked in-process before anything is uploaded or queued to ComfyUI.
+# Clients are keyed by API key header when present, otherwise by IP address.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_PER_MINUTE = 20 # Sustained requests per client per minute (bucket refill rate)
+RATE_LIMIT_BURST = 5 # Bucket capacity: requests a client may make back-to-back
+MAX_CONCURRENT_PER_CLIENT = 1 # In-flight requests per client
+API_KEY_HEADER = "X-API-Key"
+# SHA-256 hex digests of the API keys allowed their own bucket (comma-separated env var).
+# Unknown keys are ignored and the caller is keyed by IP, so random keys can't mint fresh buckets.
+API_KEY_HASHES = {h.strip().lower() for h in os.environ.get("RMBG_API_KEY_HASHES", "").split(",") if h.strip()}
+TRUST_FORWARDED_FOR = False # Set True behind a reverse proxy that sets X-Forwarded-For
+MAX_TRACKED_CLIENTS = 10000 # Idle full buckets are pruned past this size
+
+# --- Bulk Background Removal ---
+BULK_MAX_FILES = 100 # Max images per bulk request (multipart files or zip entries)
+BULK_MAX_PENDING = 2 # Prompts kept queued in ComfyUI at once, so the next image is always ready
+BULK_UPLOAD_WORKERS = 4 # Parallel uploads to ComfyUI's /upload/image
+BULK_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+BULK_MAX_ENTRY_BYTES = 25 * 1024 * 1024 # Max uncompressed size of a single zip entry
+BULK_MAX_TOTAL_BYTES = 200 * 1024 * 1024 # Max uncompressed size of all zip entries together
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024 # Request body limit (Flask answers 413 above this)
+
+# --- Warm-up / Readiness ---
+# On startup a background thread waits for ComfyUI, then runs a tiny prompt through the
+# workflow so checkpoint/model loads happen before real traffic. /ready reports 503 until then.
+WARMUP_ON_STARTUP = True
+WARMUP_RETRY_INTERVAL = 5 # seconds before the first retry while ComfyUI is unreachable or warm-up fails
+WARMUP_MAX_RETRY_INTERVAL = 60 # Retry delay doubles up to this cap; warm-up never gives up
+READINESS_CHECK_TIMEOUT = 2 # seconds for the ComfyUI reachability check in /ready
+WARMUP_SIZE = 64 # Width/height of the blank warm-up image
+FLASK_DEBUG = True # Use debug=False in a production environment
+
+# --- Job Journal ---
+# Every queued prompt is written to a small SQLite journal with its bindings and status.
+# Unfinished entries whose owning process is gone are reattached (websocket if still
+# queued/running in ComfyUI, history otherwise) and their outputs saved, so finished GPU
+# work isn't thrown away. Each row records the process that owns it; live processes refresh
+# a heartbeat, and a row is only recovered after its owner's heartbeat goes stale and
+# another process atomically claims it.
+JOURNAL_ENABLED = True
+JOURNAL_FILENAME = "jobs_rembg.sqlite3"
+JOURNAL_RETENTION_DAYS = 7 # Finished entries older than this are pruned
+JOURNAL_HEARTBEAT_INTERVAL = 10 # seconds between this process's owner heartbeats
+JOURNAL_OWNER_TIMEOUT = 60 # seconds without a heartbeat before an owner counts as gone
+RECOVERY_SCAN_INTERVAL = 30 # seconds between scans for orphaned entries
+RECOVERY_MAX_WORKERS = 4 # Journaled prompts reattached in parallel (each needs its own websocket)
+# Websocket images never reach ComfyUI's history. With the default (False) and websocket images
+# on, a prompt that finishes while no process is attached to it is marked 'lost'; prompts still
+# queued/running are reattached and recovered as usual. Setting True adds a PreviewImage twin to
+# each websocket output whose temp file recovery can fetch via /view, at the cost of bringing back
+# the temp PNG write (one per output node, warm-up and bulk included) that websocket delivery avoids.
+JOURNAL_DISK_OUTPUTS = False
+DISK_OUTPUT_NODE_SUFFIX = "_disk"
+
+# --- Websocket Image Delivery ---
+# When True, the PreviewImage nodes are swapped for ComfyUI's SaveImageWebsocket node and the
+# PNG bytes are read straight off the websocket (no temp file on disk, no /view request per node).
+USE_WEBSOCKET_IMAGES = True
+WEBSOCKET_OUTPUT_CLASS = "SaveImageWebsocket"
+WEBSOCKET_TIMEOUT = 120 # seconds
+# Binary frame layout: 4-byte event type, 4-byte image format, then the encoded image
+WS_BINARY_PREVIEW_IMAGE = 1
+WS_BINARY_HEADER_SIZE = 8
+
 # --- Dynamic Paths ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 RMBG_WORKFLOW_FILE_PATH = os.path.join(BASE_DIR, RMBG_WORKFLOW_FILENAME)
@@ -28,10 +102,29 @@ RMBG_WORKFLOW_FILE_PATH = os.path.join(BASE_DIR, RMBG_WORKFLOW_FILENAME)
 UPLOAD_DIR = os.path.join(BASE_DIR, 'uploads_rembg')
 # Directory to save final output images (optional, for debugging/logging)
 OUTPUT_DIR = os.path.join(BASE_DIR, 'outputs_rembg')
+# SQLite job journal
+JOURNAL_PATH = os.path.join(BASE_DIR, JOURNAL_FILENAME)
 # --- End Configuration ---
 
 app = Flask(__name__)
-CORS(app) # Enable CORS for all routes
+CORS(app, expose_headers=["X-Prompt-Id"]) # Enable CORS for all routes (expose the prompt ID for /jobs lookups)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Admission control state: client key -> (tokens, last refill time) and in-flight counts
+_admission_lock = threading.Lock()
+_buckets = {}
+_in_flight = {}
+
+# Warm-up state reported by /ready ("done" drops to False only once a warm-up thread is started)
+_warmup_state = {"done": True, "error": None}
+_background_tasks_lock = threading.Lock()
+_background_tasks_started = False
+
+# Job journal: one SQLite connection per call, serialized by this lock
+_journal_lock = threading.Lock()
+_journal_initialized = False
+# Journal owner identity of this process (regenerated after a fork, see get_instance_id)
+_instance = {"pid": None, "id": None}
 
 def ensure_directory(dir_path):
     """Ensures a directory exists, creating it if necessary."""
@@ -104,6 +197,112 @@ def upload_image_to_comfyui(image_bytes, filename="temp_upload.png"):
         return None, None, None
 
 
+def use_websocket_outputs(workflow, node_ids):
+    """Swaps the given image output nodes for websocket-sending output nodes."""
+    for node_id in node_ids:
+        workflow[node_id]['class_type'] = WEBSOCKET_OUTPUT_CLASS
+        workflow[node_id]['_meta'] = {"title": "Websocket Image Save"}
+        if JOURNAL_ENABLED and JOURNAL_DISK_OUTPUTS:
+            workflow[node_id + DISK_OUTPUT_NODE_SUFFIX] = {
+                "inputs": {"images": workflow[node_id]['inputs']['images']},
+                "class_type": "PreviewImage",
+                "_meta": {"title": "Preview Image (journal recovery)"}
+            }
+
+def connect_websocket(client_id):
+    """Opens a websocket to ComfyUI for the given client ID (connect BEFORE queuing to avoid missing frames)."""
+    ws_url = f"ws://{COMFYUI_URL.split('//')[1]}/ws?clientId={client_id}"
+    ws = websocket.WebSocket()
+    ws.settimeout(WEBSOCKET_TIMEOUT)
+    ws.connect(ws_url)
+    print(f"Websocket connected for client_id: {client_id}")
+    return ws
+
+def receive_images_via_websocket(ws, prompt_id, target_node_ids):
+    """
+    Reads websocket messages until the prompt finishes, collecting the binary image
+    frames sent while one of the target nodes is executing.
+
+    Returns:
+        dict: Target node IDs mapped to raw image bytes (nodes that sent nothing are missing).
+              Returns None if a websocket error occurs.
+
+    Raises:
+        websocket.WebSocketTimeoutException: If ComfyUI goes quiet for WEBSOCKET_TIMEOUT seconds.
+    """
+    target_node_set = set(target_node_ids)
+    images = {}
+    current_node = None
+
+    try:
+        while True:
+            out = ws.recv()
+            if isinstance(out, str):
+                message = json.loads(out)
+                msg_type = message.get('type')
+                data = message.get('data') or {}
+
+                if msg_type == 'executing' and data.get('prompt_id') == prompt_id:
+                    current_node = data.get('node')
+                    if current_node is None: # Prompt finished
+                        print(f"Execution finished for prompt_id: {prompt_id}")
+                        break
+                elif msg_type == 'execution_error' and data.get('prompt_id') == prompt_id:
+                    print(f"Error: ComfyUI reported an execution error for prompt {prompt_id}: {data.get('exception_message')}")
+                    break
+            else:
+                # Binary frame; only keep images sent by our output nodes
+                if current_node in target_node_set and len(out) > WS_BINARY_HEADER_SIZE:
+                    event_type = int.from_bytes(out[:4], 'big')
+                    if event_type == WS_BINARY_PREVIEW_IMAGE:
+                        images[current_node] = out[WS_BINARY_HEADER_SIZE:]
+                        print(f"  -> Received {len(images[current_node])} bytes for node {current_node} via websocket.")
+        return images
+    except websocket.WebSocketTimeoutException:
+        print(f"Error: Websocket timed out waiting for nodes: {target_node_set - set(images)}")
+        raise
+    except Exception as e:
+        print(f"Websocket error while receiving images for prompt {prompt_id}: {e}")
+        return None
+
+def run_workflow_via_websocket(workflow, bindings=None):
+    """
+    Queues the workflow with its output nodes swapped for websocket outputs, journaling
+    the prompt when `bindings` are given.
+    Returns a tuple of (prompt_id, {node_id: image bytes}) or (None, None) on failure.
+
+    Raises:
+        websocket.WebSocketTimeoutException: If ComfyUI goes quiet while the prompt runs
+            (the exception's `prompt_id` attribute names the queued prompt).
+    """
+    use_websocket_outputs(workflow, RMBG_OUTPUT_NODE_IDS)
+    client_id = str(uuid.uuid4())
+    try:
+        ws = connect_websocket(client_id)
+    except Exception as e:
+        print(f"Error: Could not open websocket to ComfyUI: {e}")
+        return None, None
+
+    try:
+        queue_response = queue_prompt(workflow, client_id)
+        if not queue_response or 'prompt_id' not in queue_response:
+            print("Error: Failed to queue prompt. Queue response:", queue_response)
+            return None, None
+
+        prompt_id = queue_response['prompt_id']
+        print(f"RMBG Prompt queued successfully. Prompt ID: {prompt_id}")
+        if bindings is not None:
+            journal_record(prompt_id, client_id, bindings)
+        try:
+            return prompt_id, receive_images_via_websocket(ws, prompt_id, RMBG_OUTPUT_NODE_IDS)
+        except websocket.WebSocketTimeoutException as e:
+            e.prompt_id = prompt_id
+            raise
+    finally:
+        try: ws.close()
+        except Exception as close_err: print(f"Error closing websocket: {close_err}")
+
+
 def get_image_filenames_via_websocket(client_id, prompt_id, target_node_ids):
     """
     Connects to ComfyUI websocket, waits for execution data for the
@@ -204,7 +403,592 @@ def get_image_filenames_via_websocket(client_id, prompt_id, target_node_ids):
                  print(f"Error closing websocket in finally block: {close_err}")
 
 
+def build_rmbg_workflow(uploaded_filename):
+    """Loads the RMBG workflow and points its LoadImage node at an uploaded file. Raises ValueError on bad workflows."""
+    try:
+        with open(RMBG_WORKFLOW_FILE_PATH, 'r') as f:
+            workflow = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Failed to load workflow file '{RMBG_WORKFLOW_FILENAME}': {e}")
+    if 'image' not in workflow.get(RMBG_INPUT_NODE_ID, {}).get('inputs', {}):
+        raise ValueError(f"Workflow structure error: Cannot find 'inputs.image' in node {RMBG_INPUT_NODE_ID}.")
+    workflow[RMBG_INPUT_NODE_ID]['inputs']['image'] = uploaded_filename
+    if USE_WEBSOCKET_IMAGES:
+        use_websocket_outputs(workflow, RMBG_OUTPUT_NODE_IDS)
+    return workflow
+
+def collect_bulk_inputs():
+    """
+    Gathers (filename, loader) pairs from the request: every 'images' file part, plus the
+    image entries of an optional 'archive' zip file part. Nothing is decompressed here;
+    call each loader (after admission) to get the image bytes.
+
+    Raises:
+        ValueError: If there are too many images or the zip entries are too large.
+        zipfile.BadZipFile: If 'archive' is not a valid zip file.
+    """
+    items = []
+    for file in request.files.getlist('images'):
+        if file.filename:
+            items.append((file.filename, file.read))
+
+    archive = request.files.get('archive')
+    if archive and archive.filename:
+        zf = zipfile.ZipFile(io.BytesIO(archive.read()))
+        entries = [info for info in zf.infolist()
+                   if not info.is_dir() and not info.filename.startswith('__MACOSX/')
+                   and info.filename.lower().endswith(BULK_IMAGE_EXTENSIONS)]
+        if len(items) + len(entries) > BULK_MAX_FILES:
+            raise ValueError(f"Too many images ({len(items) + len(entries)}). Maximum is {BULK_MAX_FILES} per request.")
+        total_bytes = 0
+        for info in entries:
+            # zipfile stops reading at the declared file_size, so these checks bound decompression
+            if info.file_size > BULK_MAX_ENTRY_BYTES:
+                raise ValueError(f"Zip entry '{info.filename}' is too large ({info.file_size} bytes). Maximum is {BULK_MAX_ENTRY_BYTES}.")
+            total_bytes += info.file_size
+            if total_bytes > BULK_MAX_TOTAL_BYTES:
+                raise ValueError(f"Zip contents are too large. Maximum is {BULK_MAX_TOTAL_BYTES} bytes uncompressed.")
+            items.append((info.filename, functools.partial(zf.read, info)))
+
+    if len(items) > BULK_MAX_FILES:
+        raise ValueError(f"Too many images ({len(items)}). Maximum is {BULK_MAX_FILES} per request.")
+    return items
+
+def fetch_outputs_from_history(prompt_id):
+    """
+    Fetches output image bytes for a finished prompt via /history + /view, from the output
+    nodes themselves or, in websocket mode, from their journal PreviewImage twins.
+    """
+    history = get_history(prompt_id) or {}
+    outputs = history.get(prompt_id, {}).get('outputs', {})
+    images = {}
+    for node_id in RMBG_OUTPUT_NODE_IDS:
+        node_images = (outputs.get(node_id, {}).get('images')
+                       or outputs.get(node_id + DISK_OUTPUT_NODE_SUFFIX, {}).get('images'))
+        if node_images:
+            info = node_images[0]
+            image_data = get_image_data(info['filename'], info.get('subfolder', ''), info.get('type', 'output'))
+            if image_data:
+                images[node_id] = image_data
+    return images
+
+def format_bulk_result(index, source_name, prompt_id, images):
+    """Builds one streamed result line for a finished image, saves its outputs locally and finalizes its journal entry."""
+    results = {}
+    saved_paths = []
+    for node_id in RMBG_OUTPUT_NODE_IDS:
+        image_data = images.get(node_id)
+        if not image_data:
+            results[f"node_{node_id}"] = {"error": "No image received for this node"}
+            continue
+        results[f"node_{node_id}"] = {"image_data_base64": base64.b64encode(image_data).decode('utf-8')}
+        try:
+            save_path = os.path.join(OUTPUT_DIR, f"{prompt_id}_{node_id}_bulk_{index}.png")
+            with open(save_path, 'wb') as f_save:
+                f_save.write(image_data)
+            saved_paths.append(save_path)
+        except Exception as e:
+            print(f"Warning: Could not save bulk output locally for image {index}, node {node_id}: {e}")
+    entry = {"index": index, "filename": source_name, "prompt_id": prompt_id, "results": results}
+    if not images:
+        entry["error"] = "Failed to retrieve any output images."
+    journal_update(prompt_id, 'completed' if images else 'failed', saved_paths)
+    return entry
+
+def run_bulk_pipeline(items, ws, client_id):
+    """
+    Generator yielding one result dict per input image, in completion order.
+
+    Uploads run ahead on a thread pool while up to BULK_MAX_PENDING prompts sit in
+    ComfyUI's queue, so the GPU moves straight to the next image instead of idling
+    through an upload/queue round trip. One websocket (one client ID) tracks every prompt;
+    it is closed when the generator finishes.
+    """
+    executor = ThreadPoolExecutor(max_workers=BULK_UPLOAD_WORKERS)
+    try:
+        upload_futures = [
+            executor.submit(upload_image_to_comfyui, image_bytes, get_unique_filename(prefix=f"upload_bulk_{index}"))
+            for index, (_, image_bytes) in enumerate(items)
+        ]
+        next_index = 0
+        pending = {} # prompt_id -> (index, source name)
+        images = {} # prompt_id -> {node_id: bytes}
+        current_prompt, current_node = None, None
+
+        while next_index < len(items) or pending:
+            # Keep ComfyUI's queue topped up
+            while next_index < len(items) and len(pending) < BULK_MAX_PENDING:
+                index, (source_name, _) = next_index, items[next_index]
+                next_index += 1
+                uploaded_filename, _, _ = upload_futures[index].result()
+                if not uploaded_filename:
+                    yield {"index": index, "filename": source_name, "error": "Failed to upload image to ComfyUI."}
+                    continue
+                try:
+                    workflow = build_rmbg_workflow(uploaded_filename)
+                except ValueError as e:
+                    yield {"index": index, "filename": source_name, "error": str(e)}
+                    continue
+                queue_response = queue_prompt(workflow, client_id)
+                if not queue_response or 'prompt_id' not in queue_response:
+                    yield {"index": index, "filename": source_name, "error": "Failed to queue prompt with ComfyUI."}
+                    continue
+                journal_record(queue_response['prompt_id'], client_id,
+                               {"source": source_name, "uploaded": uploaded_filename, "bulk_index": index})
+                pending[queue_response['prompt_id']] = (index, source_name)
+                images[queue_response['prompt_id']] = {}
+                print(f"Bulk: queued image {index} ({source_name}) as prompt {queue_response['prompt_id']}")
+
+            if not pending:
+                continue
+
+            try:
+                out = ws.recv()
+            except websocket.WebSocketTimeoutException:
+                print(f"Error: Bulk websocket timed out with {len(pending)} prompt(s) pending.")
+                for prompt_id, (index, source_name) in pending.items():
+                    journal_give_up(prompt_id)
+                    yield {"index": index, "filename": source_name, "error": "Timed out waiting for ComfyUI."}
+                pending.clear()
+                # Items never queued still get a line, so the client can tell exactly which files to resend
+                for index in range(next_index, len(items)):
+                    yield {"index": index, "filename": items[index][0],
+                           "error": "Not processed: bulk run aborted after a ComfyUI timeout."}
+                break
+
+            if not isinstance(out, str):
+                if current_prompt in pending and current_node in RMBG_OUTPUT_NODE_IDS and len(out) > WS_BINARY_HEADER_SIZE:
+                    if int.from_bytes(out[:4], 'big') == WS_BINARY_PREVIEW_IMAGE:
+                        images[current_prompt][current_node] = out[WS_BINARY_HEADER_SIZE:]
+                continue
+
+            message = json.loads(out)
+            msg_type = message.get('type')
+            data = message.get('data') or {}
+            prompt_id = data.get('prompt_id')
+            if prompt_id not in pending:
+                continue
+
+            if msg_type == 'executing':
+                current_prompt, current_node = prompt_id, data.get('node')
+                if current_node is None: # Prompt finished
+                    index, source_name = pending.pop(prompt_id)
+                    prompt_images = images.pop(prompt_id)
+                    if not USE_WEBSOCKET_IMAGES:
+                        prompt_images = fetch_outputs_from_history(prompt_id)
+                    yield format_bulk_result(index, source_name, prompt_id, prompt_images)
+            elif msg_type == 'execution_error':
+                index, source_name = pending.pop(prompt_id)
+                images.pop(prompt_id, None)
+                journal_update(prompt_id, 'failed')
+                yield {"index": index, "filename": source_name, "prompt_id": prompt_id,
+                       "error": f"ComfyUI execution error: {data.get('exception_message')}"}
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        try: ws.close()
+        except Exception as close_err: print(f"Error closing websocket: {close_err}")
+
+
+def run_warmup():
+    """Uploads a tiny blank image and runs it through the RMBG workflow. Returns an error message or None."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (WARMUP_SIZE, WARMUP_SIZE), (255, 255, 255)).save(buffer, format='PNG')
+    uploaded_filename, _, _ = upload_image_to_comfyui(buffer.getvalue(), get_unique_filename(prefix="warmup_rembg"))
+    if not uploaded_filename:
+        return "Failed to upload warm-up image."
+    try:
+        workflow = build_rmbg_workflow(uploaded_filename)
+    except ValueError as e:
+        return str(e)
+    try:
+        prompt_id, images = run_workflow_via_websocket(workflow)
+    except websocket.WebSocketTimeoutException:
+        return f"Timed out after {WEBSOCKET_TIMEOUT}s waiting for the warm-up prompt."
+    if not prompt_id or not images:
+        return "Warm-up prompt did not produce any output images."
+    return None
+
+def is_comfyui_reachable(timeout=READINESS_CHECK_TIMEOUT):
+    """Returns True if ComfyUI answers on /system_stats."""
+    try:
+        with urllib.request.urlopen(f"{COMFYUI_URL}/system_stats", timeout=timeout) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+def warmup_worker():
+    """Background thread: waits for ComfyUI, then retries the warm-up prompt (capped backoff) until it succeeds."""
+    attempt = 0
+    while True:
+        attempt += 1
+        if not is_comfyui_reachable():
+            _warmup_state["error"] = "ComfyUI not reachable"
+            print(f"Warm-up: ComfyUI not reachable yet (attempt {attempt}).")
+        else:
+            start_time = time.time()
+            error = run_warmup()
+            if error is None:
+                _warmup_state.update(done=True, error=None)
+                print(f"Warm-up: completed in {time.time() - start_time:.1f}s. Service is ready.")
+                return
+            _warmup_state["error"] = error
+            print(f"Warm-up: failed (attempt {attempt}): {error}")
+        time.sleep(min(WARMUP_RETRY_INTERVAL * 2 ** min(attempt - 1, 16), WARMUP_MAX_RETRY_INTERVAL))
+
+def start_warmup():
+    """Starts the warm-up thread (no-op when disabled)."""
+    if WARMUP_ON_STARTUP:
+        _warmup_state["done"] = False
+        threading.Thread(target=warmup_worker, name="comfyui-warmup", daemon=True).start()
+
+def get_instance_id():
+    """Identifies this process as a journal owner: a UUID plus the pid, regenerated after a fork."""
+    with _journal_lock:
+        if _instance["pid"] != os.getpid():
+            _instance.update(pid=os.getpid(), id=f"{uuid.uuid4()}:{os.getpid()}")
+        return _instance["id"]
+
+def journal_execute(sql, params=(), rowcount=False):
+    """
+    Runs one statement against the job journal and returns its rows (or its rowcount).
+    Errors are logged, never raised (the journal is best-effort).
+    """
+    global _journal_initialized
+    if not JOURNAL_ENABLED:
+        return 0 if rowcount else []
+    try:
+        with _journal_lock, closing(sqlite3.connect(JOURNAL_PATH, timeout=10)) as conn, conn:
+            if not _journal_initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "prompt_id TEXT PRIMARY KEY, client_id TEXT, bindings TEXT, status TEXT, "
+                    "result TEXT, created_at REAL, updated_at REAL, owner TEXT)"
+                )
+                if 'owner' not in [column[1] for column in conn.execute("PRAGMA table_info(jobs)")]:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT") # Journals created before ownership
+                conn.execute("CREATE TABLE IF NOT EXISTS instances (instance_id TEXT PRIMARY KEY, heartbeat_at REAL)")
+                _journal_initialized = True
+            cursor = conn.execute(sql, params)
+            return cursor.rowcount if rowcount else cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"Warning: Job journal error: {e}")
+        return 0 if rowcount else []
+
+def journal_record(prompt_id, client_id, bindings):
+    """Journals a freshly queued prompt as 'queued', owned by this process."""
+    now = time.time()
+    journal_execute(
+        "INSERT OR REPLACE INTO jobs (prompt_id, client_id, bindings, status, result, created_at, updated_at, owner) "
+        "VALUES (?, ?, ?, 'queued', NULL, ?, ?, ?)",
+        (prompt_id, client_id, json.dumps(bindings), now, now, get_instance_id())
+    )
+
+def journal_heartbeat():
+    """Marks this process as a live journal owner."""
+    journal_execute(
+        "INSERT OR REPLACE INTO instances (instance_id, heartbeat_at) VALUES (?, ?)",
+        (get_instance_id(), time.time())
+    )
+
+def journal_claim(prompt_id, previous_owner):
+    """Atomically takes over an orphaned entry. Returns False if another process claimed it first."""
+    return journal_execute(
+        "UPDATE jobs SET status = 'recovering', owner = ?, updated_at = ? "
+        "WHERE prompt_id = ? AND status IN ('queued', 'recovering') AND owner IS ?",
+        (get_instance_id(), time.time(), prompt_id, previous_owner),
+        rowcount=True
+    ) == 1
+
+def journal_update(prompt_id, status, result=None):
+    """Sets a journaled prompt's status ('completed', 'failed' or 'lost') and optional result."""
+    journal_execute(
+        "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE prompt_id = ?",
+        (status, json.dumps(result) if result is not None else None, time.time(), prompt_id)
+    )
+
+def journal_get(prompt_id):
+    """Returns a journaled prompt's entry as a dict, or None if it isn't journaled."""
+    rows = journal_execute(
+        "SELECT status, bindings, result, created_at, updated_at FROM jobs WHERE prompt_id = ?", (prompt_id,)
+    )
+    if not rows:
+        return None
+    status, bindings, result, created_at, updated_at = rows[0]
+    return {
+        "prompt_id": prompt_id,
+        "status": status,
+        "bindings": json.loads(bindings or '{}'),
+        "result": json.loads(result) if result is not None else None,
+        "created_at": created_at,
+        "updated_at": updated_at
+    }
+
+def get_queue():
+    """Retrieves ComfyUI's running and pending queue."""
+    try:
+        with urllib.request.urlopen(f"{COMFYUI_URL}/queue") as response:
+            return json.loads(response.read())
+    except Exception as e:
+        print(f"Error fetching queue: {e}")
+        return None
+
+def get_prompt_state(prompt_id):
+    """
+    Asks ComfyUI where a prompt stands.
+
+    Returns:
+        str: 'finished' if it is in /history, 'queued' if it is queued or running, else None.
+
+    Raises:
+        ConnectionError: If ComfyUI can't be asked (the prompt's fate is unknown).
+    """
+    history = get_history(prompt_id)
+    if history and prompt_id in history:
+        return 'finished'
+    queue = get_queue()
+    if history is None or queue is None:
+        raise ConnectionError(f"Could not reach ComfyUI to check prompt {prompt_id}.")
+    queued_ids = {item[1] for item in queue.get('queue_running', []) + queue.get('queue_pending', [])}
+    return 'queued' if prompt_id in queued_ids else None
+
+def journal_release(prompt_id):
+    """Hands a journaled prompt back to recovery: 'queued' with no owner, so any process may claim it."""
+    journal_execute(
+        "UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE prompt_id = ? AND status IN ('queued', 'recovering')",
+        (time.time(), prompt_id)
+    )
+
+def journal_give_up(prompt_id):
+    """
+    Called when a live request stops waiting for a prompt. If ComfyUI may still produce
+    (or already has) its outputs, the entry is released to recovery instead of being written off.
+    """
+    try:
+        state = get_prompt_state(prompt_id)
+    except ConnectionError:
+        state = 'unknown' # Let recovery decide once ComfyUI answers again
+    if state is None:
+        journal_update(prompt_id, 'failed')
+    else:
+        print(f"Handing prompt {prompt_id} ({state}) to journal recovery.")
+        journal_release(prompt_id)
+
+def collect_journaled_outputs(prompt_id, client_id):
+    """
+    Collects output image bytes for a journaled prompt, waiting for as long as ComfyUI
+    still has it queued or running.
+
+    Returns:
+        dict: Output node IDs mapped to image bytes (empty if the prompt finished but its
+              images only went out over a websocket nobody was reading).
+              Returns None if neither ComfyUI's history nor its queue knows the prompt.
+
+    Raises:
+        ConnectionError: If ComfyUI stops answering.
+    """
+    state = get_prompt_state(prompt_id)
+    while state == 'queued':
+        # Reconnect with the original client ID so ComfyUI routes the prompt's messages to us
+        print(f"Recovery: prompt {prompt_id} is still in ComfyUI's queue, reattaching via websocket.")
+        ws = connect_websocket(client_id)
+        try:
+            state = get_prompt_state(prompt_id) # It may have finished while we connected
+            if state != 'queued':
+                break
+            try:
+                images = receive_images_via_websocket(ws, prompt_id, RMBG_OUTPUT_NODE_IDS)
+            except websocket.WebSocketTimeoutException:
+                print(f"Recovery: no news for prompt {prompt_id} after {WEBSOCKET_TIMEOUT}s, re-checking the queue.")
+                images = {}
+            if images:
+                return images
+            state = get_prompt_state(prompt_id)
+            if images is None and state == 'queued':
+                time.sleep(1) # Websocket error: brief pause before reconnecting
+        finally:
+            try: ws.close()
+            except Exception as close_err: print(f"Error closing websocket: {close_err}")
+    if state is None:
+        return None
+    return fetch_outputs_from_history(prompt_id)
+
+def recover_job(prompt_id, client_id, bindings):
+    """Collects a journaled prompt's images into OUTPUT_DIR and finalizes its journal entry."""
+    try:
+        images = collect_journaled_outputs(prompt_id, client_id)
+    except Exception as e:
+        print(f"Recovery: error collecting prompt {prompt_id}, releasing it for a later attempt: {e}")
+        journal_release(prompt_id)
+        return
+    if images is None:
+        print(f"Recovery: ComfyUI no longer knows prompt {prompt_id}, marking as lost.")
+        journal_update(prompt_id, 'lost')
+        return
+    if not images:
+        print(f"Recovery: prompt {prompt_id} finished but its outputs are not retrievable, marking as lost.")
+        journal_update(prompt_id, 'lost')
+        return
+    saved_paths = []
+    ensure_directory(OUTPUT_DIR)
+    for node_id, image_data in images.items():
+        try:
+            save_path = os.path.join(OUTPUT_DIR, f"{prompt_id}_{node_id}_recovered.png")
+            with open(save_path, 'wb') as f_save:
+                f_save.write(image_data)
+            saved_paths.append(save_path)
+        except Exception as e:
+            print(f"Recovery: could not save prompt {prompt_id}, node {node_id}: {e}")
+    print(f"Recovery: saved {len(saved_paths)} image(s) for prompt {prompt_id} ({bindings.get('source', 'unknown source')})")
+    journal_update(prompt_id, 'completed' if saved_paths else 'failed', saved_paths)
+
+def heartbeat_worker():
+    """Background thread: keeps this process's journal rows from being treated as orphaned."""
+    while True:
+        time.sleep(JOURNAL_HEARTBEAT_INTERVAL)
+        journal_heartbeat()
+
+def recovery_worker():
+    """Background thread: periodically prunes the journal and recovers entries whose owning process is gone."""
+    executor = ThreadPoolExecutor(max_workers=RECOVERY_MAX_WORKERS)
+    running = []
+    while True:
+        running = [future for future in running if not future.done()]
+        free_slots = RECOVERY_MAX_WORKERS - len(running)
+        if free_slots > 0 and is_comfyui_reachable():
+            now = time.time()
+            journal_execute(
+                "DELETE FROM jobs WHERE status NOT IN ('queued', 'recovering') AND updated_at < ?",
+                (now - JOURNAL_RETENTION_DAYS * 86400,)
+            )
+            journal_execute("DELETE FROM instances WHERE heartbeat_at < ?", (now - JOURNAL_RETENTION_DAYS * 86400,))
+            # Only claim as many entries as can be reattached right away (each needs its websocket read)
+            jobs = journal_execute(
+                "SELECT prompt_id, client_id, bindings, owner FROM jobs WHERE status IN ('queued', 'recovering') "
+                "AND (owner IS NULL OR owner NOT IN (SELECT instance_id FROM instances WHERE heartbeat_at >= ?)) "
+                "ORDER BY created_at LIMIT ?",
+                (now - JOURNAL_OWNER_TIMEOUT, free_slots)
+            )
+            for prompt_id, client_id, bindings, owner in jobs:
+                if not journal_claim(prompt_id, owner):
+                    continue # Another process got there first
+                print(f"Recovery: claimed orphaned prompt {prompt_id} (previous owner: {owner or 'none'}).")
+                running.append(executor.submit(recover_job, prompt_id, client_id, json.loads(bindings or '{}')))
+        time.sleep(RECOVERY_SCAN_INTERVAL)
+
+def start_recovery():
+    """Registers this process as a journal owner and starts the heartbeat and recovery threads (no-op when disabled)."""
+    if JOURNAL_ENABLED:
+        journal_heartbeat()
+        threading.Thread(target=heartbeat_worker, name="journal-heartbeat", daemon=True).start()
+        threading.Thread(target=recovery_worker, name="journal-recovery", daemon=True).start()
+
+def get_client_key():
+    """Identifies the caller for admission control: allow-listed API key if sent, else client IP."""
+    api_key = request.headers.get(API_KEY_HEADER)
+    if api_key:
+        key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        if key_hash in API_KEY_HASHES:
+            return f"key:{key_hash[:16]}" # Hash prefix keeps raw keys out of logs
+    if TRUST_FORWARDED_FOR and request.headers.get('X-Forwarded-For'):
+        return f"ip:{request.headers['X-Forwarded-For'].split(',')[0].strip()}"
+    return f"ip:{request.remote_addr}"
+
+def try_admit(client_key, cost=1):
+    """
+    Takes `cost` tokens from the client's bucket and reserves a concurrency slot.
+    A request costing more than the bucket holds is admitted once the bucket is full
+    and leaves it in debt, so the client waits for the full cost before its next request.
+
+    Returns:
+        tuple: (True, 0) if admitted, otherwise (False, retry_after_seconds).
+    """
+    refill_per_sec = RATE_LIMIT_PER_MINUTE / 60.0
+    now = time.monotonic()
+    with _admission_lock:
+        if len(_buckets) > MAX_TRACKED_CLIENTS:
+            for key in [k for k, (tokens, last) in _buckets.items()
+                        if not _in_flight.get(k) and tokens + (now - last) * refill_per_sec >= RATE_LIMIT_BURST]:
+                del _buckets[key]
+
+        tokens, last = _buckets.get(client_key, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * refill_per_sec)
+
+        if _in_flight.get(client_key, 0) >= MAX_CONCURRENT_PER_CLIENT:
+            _buckets[client_key] = (tokens, now)
+            return False, 1
+        required = min(cost, RATE_LIMIT_BURST) # Tokens needed up front; the rest of the cost becomes debt
+        if tokens < required:
+            _buckets[client_key] = (tokens, now)
+            return False, max(1, math.ceil((required - tokens) / refill_per_sec))
+
+        _buckets[client_key] = (tokens - cost, now)
+        _in_flight[client_key] = _in_flight.get(client_key, 0) + 1
+        return True, 0
+
+def release(client_key):
+    """Frees the concurrency slot reserved by try_admit."""
+    with _admission_lock:
+        remaining = _in_flight.get(client_key, 0) - 1
+        if remaining > 0:
+            _in_flight[client_key] = remaining
+        else:
+            _in_flight.pop(client_key, None)
+
+def rate_limit_response(client_key, retry_after):
+    """Builds the 429 response sent to a client that failed admission."""
+    print(f"Rate limit: rejected request from {client_key} (retry after {retry_after}s)")
+    response = jsonify({"error": "Too many requests. Please retry later.", "retry_after": retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def rate_limited(endpoint):
+    """Route decorator: rejects over-limit clients with 429 + Retry-After before any ComfyUI work."""
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not RATE_LIMIT_ENABLED:
+            return endpoint(*args, **kwargs)
+        client_key = get_client_key()
+        admitted, retry_after = try_admit(client_key)
+        if not admitted:
+            return rate_limit_response(client_key, retry_after)
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            release(client_key)
+    return wrapper
+
+def start_background_tasks():
+    """Starts warm-up and journal recovery, once per serving process."""
+    global _background_tasks_started
+    with _background_tasks_lock:
+        if _background_tasks_started:
+            return
+        _background_tasks_started = True
+    start_warmup()
+    start_recovery()
+
+@app.before_request
+def ensure_background_tasks():
+    # Covers servers that import the app instead of running this script (flask run, gunicorn, waitress):
+    # the first request, typically the /ready probe, starts warm-up in the process that actually serves.
+    start_background_tasks()
+
+@app.route('/ready', methods=['GET'])
+def readiness_endpoint():
+    """Readiness probe: 200 only once warm-up has finished and ComfyUI is reachable."""
+    comfyui_reachable = is_comfyui_reachable()
+    ready = comfyui_reachable and _warmup_state["done"]
+    body = {
+        "ready": ready,
+        "comfyui_reachable": comfyui_reachable,
+        "warmed_up": _warmup_state["done"],
+        "warmup_error": _warmup_state["error"]
+    }
+    return jsonify(body), 200 if ready else 503
+
 @app.route('/remove-background', methods=['POST'])
+@rate_limited
 def remove_background_endpoint():
     """Flask endpoint to remove background from an uploaded image."""
     if 'image' not in request.files:
@@ -270,83 +1054,232 @@ def remove_background_endpoint():
             print(f"Error modifying workflow node {RMBG_INPUT_NODE_ID}: {e}")
             return jsonify({"error": "Failed to modify workflow with the uploaded image."}), 500
 
-        # --- Queue Prompt ---
-        client_id = str(uuid.uuid4())
-        queue_response = queue_prompt(workflow, client_id)
+        if USE_WEBSOCKET_IMAGES:
+            bindings = {"source": file.filename, "uploaded": uploaded_filename}
+            try:
+                prompt_id, images = run_workflow_via_websocket(workflow, bindings)
+            except websocket.WebSocketTimeoutException as e:
+                print(f"Error: Timed out waiting for RMBG outputs (prompt_id {getattr(e, 'prompt_id', None)}).")
+                if getattr(e, 'prompt_id', None):
+                    journal_give_up(e.prompt_id)
+                return jsonify({
+                    "error": f"Timed out after {WEBSOCKET_TIMEOUT}s waiting for ComfyUI to send the output images.",
+                    "prompt_id": getattr(e, 'prompt_id', None)
+                }), 500
+            if prompt_id and images is None:
+                journal_give_up(prompt_id)
+            if not prompt_id or images is None:
+                return jsonify({"error": "Failed to run RMBG workflow via ComfyUI websocket.", "prompt_id": prompt_id}), 500
 
-        if not queue_response or 'prompt_id' not in queue_response:
-            print("Error: Failed to queue prompt. Queue response:", queue_response)
-            return jsonify({"error": "Failed to queue prompt with ComfyUI."}), 500
+            results = {}
+            saved_paths = []
+            ensure_directory(OUTPUT_DIR) # Ensure output dir exists for saving
+            for node_id in RMBG_OUTPUT_NODE_IDS:
+                image_data = images.get(node_id)
+                if not image_data:
+                    print(f"  -> No image received via websocket for node {node_id}.")
+                    results[f"node_{node_id}"] = {"error": "No image received for this node"}
+                    continue
+                filename = get_unique_filename(prefix=f"ws_{node_id}")
+                results[f"node_{node_id}"] = {
+                    "filename": filename,
+                    "subfolder": "",
+                    "type": "websocket",
+                    "image_data_base64": base64.b64encode(image_data).decode('utf-8')
+                }
+                # Optional: Save outputs locally for debugging/logging
+                try:
+                    save_path = os.path.join(OUTPUT_DIR, f"{prompt_id}_{node_id}_{filename}")
+                    with open(save_path, 'wb') as f_save:
+                        f_save.write(image_data)
+                    saved_paths.append(save_path)
+                    print(f"  -> Saved output locally to {save_path}")
+                except Exception as e:
+                    print(f"Warning: Could not save output image locally for node {node_id}: {e}")
+        else:
+            # --- Queue Prompt ---
+            client_id = str(uuid.uuid4())
+            queue_response = queue_prompt(workflow, client_id)
+
+            if not queue_response or 'prompt_id' not in queue_response:
+                print("Error: Failed to queue prompt. Queue response:", queue_response)
+                return jsonify({"error": "Failed to queue prompt with ComfyUI."}), 500
+
+            prompt_id = queue_response['prompt_id']
+            print(f"RMBG Prompt queued successfully. Prompt ID: {prompt_id}")
+            journal_record(prompt_id, client_id, {"source": file.filename, "uploaded": uploaded_filename})
+
+            # --- Wait for Images using Websocket ---
+            output_details = get_image_filenames_via_websocket(client_id, prompt_id, RMBG_OUTPUT_NODE_IDS)
+
+            if not output_details: # Check if None was returned (indicates connection/websocket error)
+                 print(f"Error: Failed to get output details via websocket for prompt_id {prompt_id}.")
+                 journal_give_up(prompt_id)
+                 return jsonify({"error": "Failed to get generated image details from ComfyUI (websocket error).", "prompt_id": prompt_id}), 500
+
+            if len(output_details) != len(RMBG_OUTPUT_NODE_IDS):
+                print(f"Warning: Did not receive all expected output images via websocket for prompt_id {prompt_id}.")
+                print(f"Expected: {len(RMBG_OUTPUT_NODE_IDS)}, Received: {len(output_details)}")
+                print(f"Received details: {output_details}")
+                # Attempt history lookup as a fallback
+                history = get_history(prompt_id)
+                print(f"History lookup for prompt {prompt_id}: {json.dumps(history, indent=2)}")
+                # Try to populate missing details from history if possible (complex, skipping for now)
+                # For now, proceed with what we have, but the response might be incomplete.
 
-        prompt_id = queue_response['prompt_id']
-        print(f"RMBG Prompt queued successfully. Prompt ID: {prompt_id}")
 
-        # --- Wait for Images using Websocket ---
-        output_details = get_image_filenames_via_websocket(client_id, prompt_id, RMBG_OUTPUT_NODE_IDS)
-
-        if not output_details: # Check if None was returned (indicates connection/websocket error)
-             print(f"Error: Failed to get output details via websocket for prompt_id {prompt_id}.")
-             return jsonify({"error": "Failed to get generated image details from ComfyUI (websocket error)."}), 500
-
-        if len(output_details) != len(RMBG_OUTPUT_NODE_IDS):
-            print(f"Warning: Did not receive all expected output images via websocket for prompt_id {prompt_id}.")
-            print(f"Expected: {len(RMBG_OUTPUT_NODE_IDS)}, Received: {len(output_details)}")
-            print(f"Received details: {output_details}")
-            # Attempt history lookup as a fallback
-            history = get_history(prompt_id)
-            print(f"History lookup for prompt {prompt_id}: {json.dumps(history, indent=2)}")
-            # Try to populate missing details from history if possible (complex, skipping for now)
-            # For now, proceed with what we have, but the response might be incomplete.
-
-
-        # --- Fetch Image Data for Each Output ---
-        results = {}
-        ensure_directory(OUTPUT_DIR) # Ensure output dir exists for saving
-
-        # Use RMBG_OUTPUT_NODE_IDS to ensure we check for all expected outputs
-        for node_id in RMBG_OUTPUT_NODE_IDS:
-            details = output_details.get(node_id) # Get details if received
-            if details:
-                print(f"Fetching image for node {node_id}: {details}")
-                image_data = get_image_data(details['filename'], details['subfolder'], details['type'])
-                if image_data:
-                    print(f"  -> Fetched {len(image_data)} bytes.")
-                    # Encode image data as base64 for JSON response
-                    image_data_base64 = base64.b64encode(image_data).decode('utf-8')
-                    results[f"node_{node_id}"] = {
-                        "filename": details['filename'],
-                        "subfolder": details['subfolder'],
-                        "type": details['type'],
-                        "image_data_base64": image_data_base64
-                    }
-                    # Optional: Save outputs locally for debugging/logging
-                    try:
-                        save_path = os.path.join(OUTPUT_DIR, f"{prompt_id}_{node_id}_{details['filename']}")
-                        with open(save_path, 'wb') as f_save:
-                            f_save.write(image_data)
-                        print(f"  -> Saved output locally to {save_path}")
-                    except Exception as e:
-                        print(f"Warning: Could not save output image locally for node {node_id}: {e}")
+            # --- Fetch Image Data for Each Output ---
+            results = {}
+            saved_paths = []
+            ensure_directory(OUTPUT_DIR) # Ensure output dir exists for saving
+
+            # Use RMBG_OUTPUT_NODE_IDS to ensure we check for all expected outputs
+            for node_id in RMBG_OUTPUT_NODE_IDS:
+                details = output_details.get(node_id) # Get details if received
+                if details:
+                    print(f"Fetching image for node {node_id}: {details}")
+                    image_data = get_image_data(details['filename'], details['subfolder'], details['type'])
+                    if image_data:
+                        print(f"  -> Fetched {len(image_data)} bytes.")
+                        # Encode image data as base64 for JSON response
+                        image_data_base64 = base64.b64encode(image_data).decode('utf-8')
+                        results[f"node_{node_id}"] = {
+                            "filename": details['filename'],
+                            "subfolder": details['subfolder'],
+                            "type": details['type'],
+                            "image_data_base64": image_data_base64
+                        }
+                        # Optional: Save outputs locally for debugging/logging
+                        try:
+                            save_path = os.path.join(OUTPUT_DIR, f"{prompt_id}_{node_id}_{details['filename']}")
+                            with open(save_path, 'wb') as f_save:
+                                f_save.write(image_data)
+                            saved_paths.append(save_path)
+                            print(f"  -> Saved output locally to {save_path}")
+                        except Exception as e:
+                            print(f"Warning: Could not save output image locally for node {node_id}: {e}")
+                    else:
+                        print(f"  -> Failed to fetch image data for node {node_id}.")
+                        results[f"node_{node_id}"] = {"error": "Failed to fetch image data"}
                 else:
-                    print(f"  -> Failed to fetch image data for node {node_id}.")
-                    results[f"node_{node_id}"] = {"error": "Failed to fetch image data"}
-            else:
-                 print(f"  -> No details received for node {node_id} from websocket or history.")
-                 results[f"node_{node_id}"] = {"error": "No image details found for this node"}
+                     print(f"  -> No details received for node {node_id} from websocket or history.")
+                     results[f"node_{node_id}"] = {"error": "No image details found for this node"}
 
 
         # --- Return Results ---
         print("Sending JSON response with base64 encoded images.")
         # Check if any results were actually successful
         successful_results = [k for k, v in results.items() if 'image_data_base64' in v]
+        journal_update(prompt_id, 'completed' if successful_results else 'failed', saved_paths)
         if not successful_results:
-             return jsonify({"error": "Failed to retrieve any output images.", "details": results}), 500
+             return jsonify({"error": "Failed to retrieve any output images.", "details": results, "prompt_id": prompt_id}), 500
 
-        return jsonify(results)
+        # Lets clients pick up the result via /jobs/<prompt_id> if this response is lost
+        results["prompt_id"] = prompt_id
+        response = jsonify(results)
+        response.headers['X-Prompt-Id'] = prompt_id
+        return response
 
     return jsonify({"error": "An unexpected error occurred processing the file."}), 500
 
 
+@app.route('/jobs/<prompt_id>', methods=['GET'])
+@rate_limited
+def job_status_endpoint(prompt_id):
+    """
+    Looks up a journaled prompt (e.g. one whose /remove-background request failed or timed out).
+    Returns the journal entry, plus the saved output images (base64) once it has completed.
+    """
+    if not JOURNAL_ENABLED:
+        return jsonify({"error": "The job journal is disabled on this server."}), 404
+    job = journal_get(prompt_id)
+    if job is None:
+        return jsonify({"error": f"Unknown prompt_id '{prompt_id}'."}), 404
+    saved_paths = job.pop("result") or [] # Server-side paths, not exposed to clients
+    if job["status"] == 'completed':
+        job["images"] = []
+        for save_path in saved_paths:
+            try:
+                with open(save_path, 'rb') as f_saved:
+                    image_data_base64 = base64.b64encode(f_saved.read()).decode('utf-8')
+            except OSError as e:
+                print(f"Warning: Could not read saved output {save_path} for prompt {prompt_id}: {e}")
+                continue
+            job["images"].append({"filename": os.path.basename(save_path), "image_data_base64": image_data_base64})
+        if not job["images"]:
+            job["error"] = "The images were generated but are no longer available on this server."
+    response = jsonify(job)
+    response.headers['X-Prompt-Id'] = prompt_id
+    return response
+
+@app.route('/remove-background/bulk', methods=['POST'])
+def remove_background_bulk_endpoint():
+    """
+    Flask endpoint to remove backgrounds from many images at once.
+
+    Accepts multiple 'images' file parts and/or an 'archive' zip file part, and streams
+    newline-delimited JSON: one line per image as it completes, then a summary line.
+    """
+    try:
+        sources = collect_bulk_inputs()
+    except zipfile.BadZipFile:
+        return jsonify({"error": "'archive' is not a valid zip file."}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Error reading bulk upload: {e}")
+        return jsonify({"error": "Could not read uploaded files."}), 400
+
+    if not sources:
+        return jsonify({"error": "No images found. Send 'images' file parts or an 'archive' zip."}), 400
+
+    # Admission is charged per image (before any decompression) and the concurrency slot is held until the stream ends
+    client_key = get_client_key()
+    if RATE_LIMIT_ENABLED:
+        admitted, retry_after = try_admit(client_key, cost=len(sources))
+        if not admitted:
+            return rate_limit_response(client_key, retry_after)
+
+    try:
+        items = [(name, load()) for name, load in sources]
+    except Exception as e:
+        print(f"Error reading bulk upload: {e}")
+        if RATE_LIMIT_ENABLED:
+            release(client_key)
+        return jsonify({"error": "Could not read uploaded files."}), 400
+
+    client_id = str(uuid.uuid4())
+    try:
+        ws = connect_websocket(client_id)
+    except Exception as e:
+        print(f"Error: Could not open websocket to ComfyUI: {e}")
+        if RATE_LIMIT_ENABLED:
+            release(client_key)
+        return jsonify({"error": "Failed to connect to ComfyUI websocket."}), 500
+
+    ensure_directory(OUTPUT_DIR)
+    print(f"Bulk request: {len(items)} image(s) from {client_key}")
+    pipeline = run_bulk_pipeline(items, ws, client_id)
+
+    def generate():
+        succeeded = 0
+        try:
+            for result in pipeline:
+                if 'error' not in result:
+                    succeeded += 1
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            print(f"Error in bulk pipeline: {e}")
+            yield json.dumps({"error": f"Bulk processing aborted: {e}"}) + "\n"
+        finally:
+            pipeline.close() # Closes the websocket even if the client disconnects mid-stream
+            if RATE_LIMIT_ENABLED:
+                release(client_key)
+        yield json.dumps({"done": True, "total": len(items), "succeeded": succeeded}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 if __name__ == "__main__":
     print("--- Flask ComfyUI RMBG API Server ---")
     print(f"ComfyUI URL: {COMFYUI_URL}")
@@ -354,6 +1287,11 @@ if __name__ == "__main__":
     print(f"RMBG Workflow File Path: {RMBG_WORKFLOW_FILE_PATH}")
     print(f"RMBG Input Node ID: {RMBG_INPUT_NODE_ID}")
     print(f"RMBG Output Node IDs: {RMBG_OUTPUT_NODE_IDS}")
+    print(f"Rate limit: {RATE_LIMIT_PER_MINUTE}/min, burst {RATE_LIMIT_BURST}, max concurrent {MAX_CONCURRENT_PER_CLIENT} per client" if RATE_LIMIT_ENABLED else "Rate limit: disabled")
+    print(f"Bulk: max {BULK_MAX_FILES} files, {BULK_MAX_PENDING} queued ahead, {BULK_UPLOAD_WORKERS} upload workers")
+    print(f"Warm-up on startup: {WARMUP_ON_STARTUP}")
+    print(f"Job journal: {JOURNAL_PATH if JOURNAL_ENABLED else 'disabled'}")
+    print(f"Image delivery: {'websocket (' + WEBSOCKET_OUTPUT_CLASS + ')' if USE_WEBSOCKET_IMAGES else '/view fetch'}")
     print(f"Optional Upload Dir: {UPLOAD_DIR}")
     print(f"Optional Output Dir: {OUTPUT_DIR}")
 
@@ -368,6 +1306,10 @@ if __name__ == "__main__":
     ensure_directory(UPLOAD_DIR) # Ensure directories exist at startup
     ensure_directory(OUTPUT_DIR)
 
+    # Warm up / recover right away in the serving process (the debug reloader's parent process never serves requests)
+    if not FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
+
     print("\nStarting Flask server...")
     # Run on a different port (e.g., 5002) to avoid conflict with text2img server
-    app.run(host='0.0.0.0', port=5002, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5002, debug=FLASK_DEBUG)
\ No newline at end of file
@@ -6,8 +6,15 @@ import urllib.parse
 import websocket # NOTE: needs websocket-client library
 import io
 import os
+import math
+import threading
+import functools
+import hashlib
 import time # Added for polling
 import random # Required for generating random seeds
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
@@ -23,6 +30,81 @@ WORKFLOW_FILENAME = "workflow_api.json"
 PROMPT_NODE_ID = "2" # <--- *** CHANGE THIS TO YOUR PROMPT NODE ID ***
 # The ID of the node that outputs the final image (e.g., SaveImage, PreviewImage)
 OUTPUT_NODE_ID = "7" # <--- *** CHANGE THIS TO YOUR FINAL IMAGE NODE ID ***
+# The ID of the KSampler node (seed/steps/denoise live here)
+KSAMPLER_NODE_ID = "4"
+# The ID of the EmptyLatentImage node (width/height live here)
+LATENT_NODE_ID = "5"
+
+# --- Preview / Refine Settings ---
+# "preview" renders a small, low-step draft; "refine" re-renders the same draft
+# for a given seed, upscales the latent and runs a partial-denoise pass at the
+# template's full resolution. "full" (default) runs the template unchanged.
+PREVIEW_WIDTH = 512
+PREVIEW_HEIGHT = 512
+PREVIEW_STEPS = 2
+REFINE_DENOISE = 0.5 # How much of the upscaled latent gets re-noised in the refine pass
+REFINE_UPSCALE_METHOD = "bislerp"
+# IDs for the nodes appended to the template in refine mode (must not clash with template IDs)
+REFINE_UPSCALE_NODE_ID = "100"
+REFINE_SAMPLER_NODE_ID = "101"
+GENERATION_MODES = ("full", "preview", "refine")
+
+# --- Admission Control (per-client token bucket + concurrency cap) ---
+# Checked in-process before anything is uploaded or queued to ComfyUI.
+# Clients are keyed by API key header when present, otherwise by IP address.
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_PER_MINUTE = 10 # Sustained requests per client per minute (bucket refill rate)
+RATE_LIMIT_BURST = 3 # Bucket capacity: requests a client may make back-to-back
+MAX_CONCURRENT_PER_CLIENT = 1 # In-flight requests per client
+API_KEY_HEADER = "X-API-Key"
+# SHA-256 hex digests of the API keys allowed their own bucket (comma-separated env var).
+# Unknown keys are ignored and the caller is keyed by IP, so random keys can't mint fresh buckets.
+API_KEY_HASHES = {h.strip().lower() for h in os.environ.get("TEXT2IMG_API_KEY_HASHES", "").split(",") if h.strip()}
+TRUST_FORWARDED_FOR = False # Set True behind a reverse proxy that sets X-Forwarded-For
+MAX_TRACKED_CLIENTS = 10000 # Idle full buckets are pruned past this size
+
+# --- Warm-up / Readiness ---
+# On startup a background thread waits for ComfyUI, then runs a tiny prompt through the
+# workflow so checkpoint/model loads happen before real traffic. /ready reports 503 until then.
+WARMUP_ON_STARTUP = True
+WARMUP_RETRY_INTERVAL = 5 # seconds before the first retry while ComfyUI is unreachable or warm-up fails
+WARMUP_MAX_RETRY_INTERVAL = 60 # Retry delay doubles up to this cap; warm-up never gives up
+READINESS_CHECK_TIMEOUT = 2 # seconds for the ComfyUI reachability check in /ready
+WARMUP_SIZE = 64 # Latent width/height for the warm-up render
+WARMUP_PROMPT = "warm-up"
+FLASK_DEBUG = True # Use debug=False in a production environment
+
+# --- Job Journal ---
+# Every queued prompt is written to a small SQLite journal with its bindings and status.
+# Unfinished entries whose owning process is gone are reattached (websocket if still
+# queued/running in ComfyUI, history otherwise) and their outputs saved, so finished GPU
+# work isn't thrown away. Each row records the process that owns it; live processes refresh
+# a heartbeat, and a row is only recovered after its owner's heartbeat goes stale and
+# another process atomically claims it.
+JOURNAL_ENABLED = True
+JOURNAL_FILENAME = "jobs_text2img.sqlite3"
+JOURNAL_RETENTION_DAYS = 7 # Finished entries older than this are pruned
+JOURNAL_HEARTBEAT_INTERVAL = 10 # seconds between this process's owner heartbeats
+JOURNAL_OWNER_TIMEOUT = 60 # seconds without a heartbeat before an owner counts as gone
+RECOVERY_SCAN_INTERVAL = 30 # seconds between scans for orphaned entries
+RECOVERY_MAX_WORKERS = 4 # Journaled prompts reattached in parallel (each needs its own websocket)
+# Websocket images never reach ComfyUI's history. With the default (False) and websocket images
+# on, a prompt that finishes while no process is attached to it is marked 'lost'; prompts still
+# queued/running are reattached and recovered as usual. Setting True adds a PreviewImage twin to
+# each websocket output whose temp file recovery can fetch via /view, at the cost of bringing back
+# the temp PNG write (one per output node, warm-up and bulk included) that websocket delivery avoids.
+JOURNAL_DISK_OUTPUTS = False
+DISK_OUTPUT_NODE_SUFFIX = "_disk"
+
+# --- Websocket Image Delivery ---
+# When True, the output node is swapped for ComfyUI's SaveImageWebsocket node and the
+# PNG bytes are read straight off the websocket (no temp file on disk, no /view request).
+USE_WEBSOCKET_IMAGES = True
+WEBSOCKET_OUTPUT_CLASS = "SaveImageWebsocket"
+WEBSOCKET_TIMEOUT = 120 # seconds
+# Binary frame layout: 4-byte event type, 4-byte image format, then the encoded image
+WS_BINARY_PREVIEW_IMAGE = 1
+WS_BINARY_HEADER_SIZE = 8
 
 # --- Generate a persistent Client ID for this script instance ---
 CLIENT_ID = str(uuid.uuid4())
@@ -35,10 +117,28 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 WORKFLOW_FILE_PATH = os.path.join(BASE_DIR, WORKFLOW_FILENAME)
 # Directory to save generated images
 CREATIONS_DIR = os.path.join(BASE_DIR, 'creations_comfyui')
+# SQLite job journal
+JOURNAL_PATH = os.path.join(BASE_DIR, JOURNAL_FILENAME)
 # --- End Configuration ---
 
 app = Flask(__name__)
-CORS(app) # Enable CORS for all routes
+CORS(app, expose_headers=["X-Seed", "X-Generation-Mode", "X-Prompt-Id"]) # Enable CORS for all routes (expose seed so clients can refine)
+
+# Admission control state: client key -> (tokens, last refill time) and in-flight counts
+_admission_lock = threading.Lock()
+_buckets = {}
+_in_flight = {}
+
+# Warm-up state reported by /ready ("done" drops to False only once a warm-up thread is started)
+_warmup_state = {"done": True, "error": None}
+_background_tasks_lock = threading.Lock()
+_background_tasks_started = False
+
+# Job journal: one SQLite connection per call, serialized by this lock
+_journal_lock = threading.Lock()
+_journal_initialized = False
+# Journal owner identity of this process (regenerated after a fork, see get_instance_id)
+_instance = {"pid": None, "id": None}
 
 def ensure_creations_directory():
     if not os.path.exists(CREATIONS_DIR):
@@ -51,6 +151,121 @@ def get_unique_filename(prompt_text="image"):
     safe_prompt = "".join(c if c.isalnum() else "_" for c in prompt_text[:30])
     return os.path.join(CREATIONS_DIR, f"{timestamp}_{safe_prompt}.png")
 
+def apply_preview_settings(workflow):
+    """Shrinks the latent and step count of the template for a cheap preview render."""
+    workflow[LATENT_NODE_ID]['inputs']['width'] = PREVIEW_WIDTH
+    workflow[LATENT_NODE_ID]['inputs']['height'] = PREVIEW_HEIGHT
+    workflow[KSAMPLER_NODE_ID]['inputs']['steps'] = min(PREVIEW_STEPS, workflow[KSAMPLER_NODE_ID]['inputs']['steps'])
+
+def apply_refine_settings(workflow):
+    """
+    Turns the template into a two-pass workflow: the preview pass is reproduced
+    exactly (same seed, size and steps), then its latent is upscaled to the
+    template's full resolution and refined with a partial-denoise KSampler.
+    The output node is rewired to decode the refined latent.
+    """
+    full_width = workflow[LATENT_NODE_ID]['inputs']['width']
+    full_height = workflow[LATENT_NODE_ID]['inputs']['height']
+    base_sampler_inputs = dict(workflow[KSAMPLER_NODE_ID]['inputs'])
+    apply_preview_settings(workflow)
+
+    workflow[REFINE_UPSCALE_NODE_ID] = {
+        "inputs": {
+            "upscale_method": REFINE_UPSCALE_METHOD,
+            "width": full_width,
+            "height": full_height,
+            "crop": "disabled",
+            "samples": [KSAMPLER_NODE_ID, 0]
+        },
+        "class_type": "LatentUpscale",
+        "_meta": {"title": "Upscale Latent (refine)"}
+    }
+    refine_inputs = dict(base_sampler_inputs)
+    refine_inputs['denoise'] = REFINE_DENOISE
+    refine_inputs['latent_image'] = [REFINE_UPSCALE_NODE_ID, 0]
+    refine_inputs.pop('control_after_generate', None)
+    workflow[REFINE_SAMPLER_NODE_ID] = {
+        "inputs": refine_inputs,
+        "class_type": "KSampler",
+        "_meta": {"title": "KSampler (refine)"}
+    }
+
+    # Point every consumer of the base sampler (the VAEDecode) at the refine sampler instead
+    for node_id, node in workflow.items():
+        if node_id in (REFINE_UPSCALE_NODE_ID, REFINE_SAMPLER_NODE_ID):
+            continue
+        for input_name, value in node.get('inputs', {}).items():
+            if isinstance(value, list) and value and value[0] == KSAMPLER_NODE_ID:
+                node['inputs'][input_name] = [REFINE_SAMPLER_NODE_ID, value[1]]
+
+def use_websocket_outputs(workflow, node_ids):
+    """Swaps the given image output nodes for websocket-sending output nodes."""
+    for node_id in node_ids:
+        workflow[node_id]['class_type'] = WEBSOCKET_OUTPUT_CLASS
+        workflow[node_id]['_meta'] = {"title": "Websocket Image Save"}
+        if JOURNAL_ENABLED and JOURNAL_DISK_OUTPUTS:
+            workflow[node_id + DISK_OUTPUT_NODE_SUFFIX] = {
+                "inputs": {"images": workflow[node_id]['inputs']['images']},
+                "class_type": "PreviewImage",
+                "_meta": {"title": "Preview Image (journal recovery)"}
+            }
+
+def connect_websocket(client_id):
+    """Opens a websocket to ComfyUI for the given client ID (connect BEFORE queuing to avoid missing frames)."""
+    ws_url = f"ws://{COMFYUI_URL.split('//')[1]}/ws?clientId={client_id}"
+    ws = websocket.WebSocket()
+    ws.settimeout(WEBSOCKET_TIMEOUT)
+    ws.connect(ws_url)
+    print(f"Websocket connected for client_id: {client_id}")
+    return ws
+
+def receive_images_via_websocket(ws, prompt_id, target_node_ids):
+    """
+    Reads websocket messages until the prompt finishes, collecting the binary image
+    frames sent while one of the target nodes is executing.
+
+    Returns:
+        dict: Target node IDs mapped to raw image bytes (nodes that sent nothing are missing).
+              Returns None if a websocket error occurs.
+
+    Raises:
+        websocket.WebSocketTimeoutException: If ComfyUI goes quiet for WEBSOCKET_TIMEOUT seconds.
+    """
+    target_node_set = set(target_node_ids)
+    images = {}
+    current_node = None
+
+    try:
+        while True:
+            out = ws.recv()
+            if isinstance(out, str):
+                message = json.loads(out)
+                msg_type = message.get('type')
+                data = message.get('data') or {}
+
+                if msg_type == 'executing' and data.get('prompt_id') == prompt_id:
+                    current_node = data.get('node')
+                    if current_node is None: # Prompt finished
+                        print(f"Execution finished for prompt_id: {prompt_id}")
+                        break
+                elif msg_type == 'execution_error' and data.get('prompt_id') == prompt_id:
+                    print(f"Error: ComfyUI reported an execution error for prompt {prompt_id}: {data.get('exception_message')}")
+                    break
+            else:
+                # Binary frame; only keep images sent by our output nodes (skips sampler previews)
+                if current_node in target_node_set and len(out) > WS_BINARY_HEADER_SIZE:
+                    event_type = int.from_bytes(out[:4], 'big')
+                    if event_type == WS_BINARY_PREVIEW_IMAGE:
+                        images[current_node] = out[WS_BINARY_HEADER_SIZE:]
+                        print(f"  -> Received {len(images[current_node])} bytes for node {current_node} via websocket.")
+        return images
+    except websocket.WebSocketTimeoutException:
+        print(f"Error: Websocket timed out waiting for nodes: {target_node_set - set(images)}")
+        raise
+    except Exception as e:
+        print(f"Websocket error while receiving images for prompt {prompt_id}: {e}")
+        return None
+
 def queue_prompt(prompt_workflow, client_id):
     """Sends the workflow to the ComfyUI server to be queued."""
     try:
@@ -180,7 +395,455 @@ def wait_for_output_and_get_details(prompt_id, target_node_ids, timeout=120, int
     return output_details
 
 
+def generate_via_websocket(workflow, bindings=None):
+    """
+    Queues the workflow with its output node swapped for a websocket output, journaling
+    the prompt when `bindings` are given.
+    Returns a tuple of (prompt_id, image bytes, None) on success or (prompt_id, None, error message)
+    on failure (prompt_id is None if nothing was queued).
+    """
+    use_websocket_outputs(workflow, [OUTPUT_NODE_ID])
+    # A fresh client ID per request: ComfyUI routes binary frames to a single socket per client ID
+    client_id = str(uuid.uuid4())
+    prompt_id = None
+    try:
+        ws = connect_websocket(client_id)
+    except Exception as e:
+        print(f"Error: Could not open websocket to ComfyUI: {e}")
+        return prompt_id, None, "Failed to connect to ComfyUI websocket."
+
+    try:
+        queue_response = queue_prompt(workflow, client_id)
+        if not queue_response or 'prompt_id' not in queue_response:
+            print("Error: Failed to queue prompt. Queue response:", queue_response)
+            return prompt_id, None, "Failed to queue prompt with ComfyUI. Check ComfyUI connection and logs."
+
+        prompt_id = queue_response['prompt_id']
+        print(f"Prompt queued successfully. Prompt ID: {prompt_id} (Client ID: {client_id})")
+        if bindings is not None:
+            journal_record(prompt_id, client_id, bindings)
+
+        try:
+            images = receive_images_via_websocket(ws, prompt_id, [OUTPUT_NODE_ID])
+        except websocket.WebSocketTimeoutException:
+            return prompt_id, None, f"Timed out after {WEBSOCKET_TIMEOUT}s waiting for ComfyUI to send the generated image."
+    finally:
+        try: ws.close()
+        except Exception as close_err: print(f"Error closing websocket: {close_err}")
+
+    if images is None:
+        return prompt_id, None, "Failed to get generated image from ComfyUI (websocket error)."
+    if OUTPUT_NODE_ID not in images:
+        print(f"Error: No image received via websocket for node {OUTPUT_NODE_ID} (prompt_id {prompt_id}).")
+        return prompt_id, None, "ComfyUI finished without sending the generated image."
+    return prompt_id, images[OUTPUT_NODE_ID], None
+
+
+def run_warmup():
+    """Runs the template once with a tiny latent and a single step. Returns an error message or None."""
+    try:
+        with open(WORKFLOW_FILE_PATH, 'r') as f:
+            workflow = json.load(f)
+        workflow[PROMPT_NODE_ID]['inputs']['text'] = WARMUP_PROMPT
+        workflow[LATENT_NODE_ID]['inputs']['width'] = WARMUP_SIZE
+        workflow[LATENT_NODE_ID]['inputs']['height'] = WARMUP_SIZE
+        workflow[KSAMPLER_NODE_ID]['inputs']['steps'] = 1
+        workflow[KSAMPLER_NODE_ID]['inputs']['seed'] = random.randint(0, 0xffffffffffffffff) # Avoid ComfyUI's result cache
+    except Exception as e:
+        return f"Could not prepare warm-up workflow: {e}"
+    _, _, error = generate_via_websocket(workflow)
+    return error
+
+def is_comfyui_reachable(timeout=READINESS_CHECK_TIMEOUT):
+    """Returns True if ComfyUI answers on /system_stats."""
+    try:
+        with urllib.request.urlopen(f"{COMFYUI_URL}/system_stats", timeout=timeout) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+def warmup_worker():
+    """Background thread: waits for ComfyUI, then retries the warm-up prompt (capped backoff) until it succeeds."""
+    attempt = 0
+    while True:
+        attempt += 1
+        if not is_comfyui_reachable():
+            _warmup_state["error"] = "ComfyUI not reachable"
+            print(f"Warm-up: ComfyUI not reachable yet (attempt {attempt}).")
+        else:
+            start_time = time.time()
+            error = run_warmup()
+            if error is None:
+                _warmup_state.update(done=True, error=None)
+                print(f"Warm-up: completed in {time.time() - start_time:.1f}s. Service is ready.")
+                return
+            _warmup_state["error"] = error
+            print(f"Warm-up: failed (attempt {attempt}): {error}")
+        time.sleep(min(WARMUP_RETRY_INTERVAL * 2 ** min(attempt - 1, 16), WARMUP_MAX_RETRY_INTERVAL))
+
+def start_warmup():
+    """Starts the warm-up thread (no-op when disabled)."""
+    if WARMUP_ON_STARTUP:
+        _warmup_state["done"] = False
+        threading.Thread(target=warmup_worker, name="comfyui-warmup", daemon=True).start()
+
+def fetch_outputs_from_history(prompt_id):
+    """
+    Fetches output image bytes for a finished prompt via /history + /view, from the output
+    node itself or, in websocket mode, from its journal PreviewImage twin.
+    """
+    history = get_history(prompt_id) or {}
+    outputs = history.get(prompt_id, {}).get('outputs', {})
+    node_images = (outputs.get(OUTPUT_NODE_ID, {}).get('images')
+                   or outputs.get(OUTPUT_NODE_ID + DISK_OUTPUT_NODE_SUFFIX, {}).get('images'))
+    if not node_images:
+        return {}
+    info = node_images[0]
+    image_data = get_image_data(info['filename'], info.get('subfolder', ''), info.get('type', 'output'))
+    return {OUTPUT_NODE_ID: image_data} if image_data else {}
+
+def get_instance_id():
+    """Identifies this process as a journal owner: a UUID plus the pid, regenerated after a fork."""
+    with _journal_lock:
+        if _instance["pid"] != os.getpid():
+            _instance.update(pid=os.getpid(), id=f"{uuid.uuid4()}:{os.getpid()}")
+        return _instance["id"]
+
+def journal_execute(sql, params=(), rowcount=False):
+    """
+    Runs one statement against the job journal and returns its rows (or its rowcount).
+    Errors are logged, never raised (the journal is best-effort).
+    """
+    global _journal_initialized
+    if not JOURNAL_ENABLED:
+        return 0 if rowcount else []
+    try:
+        with _journal_lock, closing(sqlite3.connect(JOURNAL_PATH, timeout=10)) as conn, conn:
+            if not _journal_initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "prompt_id TEXT PRIMARY KEY, client_id TEXT, bindings TEXT, status TEXT, "
+                    "result TEXT, created_at REAL, updated_at REAL, owner TEXT)"
+                )
+                if 'owner' not in [column[1] for column in conn.execute("PRAGMA table_info(jobs)")]:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT") # Journals created before ownership
+                conn.execute("CREATE TABLE IF NOT EXISTS instances (instance_id TEXT PRIMARY KEY, heartbeat_at REAL)")
+                _journal_initialized = True
+            cursor = conn.execute(sql, params)
+            return cursor.rowcount if rowcount else cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"Warning: Job journal error: {e}")
+        return 0 if rowcount else []
+
+def journal_record(prompt_id, client_id, bindings):
+    """Journals a freshly queued prompt as 'queued', owned by this process."""
+    now = time.time()
+    journal_execute(
+        "INSERT OR REPLACE INTO jobs (prompt_id, client_id, bindings, status, result, created_at, updated_at, owner) "
+        "VALUES (?, ?, ?, 'queued', NULL, ?, ?, ?)",
+        (prompt_id, client_id, json.dumps(bindings), now, now, get_instance_id())
+    )
+
+def journal_heartbeat():
+    """Marks this process as a live journal owner."""
+    journal_execute(
+        "INSERT OR REPLACE INTO instances (instance_id, heartbeat_at) VALUES (?, ?)",
+        (get_instance_id(), time.time())
+    )
+
+def journal_claim(prompt_id, previous_owner):
+    """Atomically takes over an orphaned entry. Returns False if another process claimed it first."""
+    return journal_execute(
+        "UPDATE jobs SET status = 'recovering', owner = ?, updated_at = ? "
+        "WHERE prompt_id = ? AND status IN ('queued', 'recovering') AND owner IS ?",
+        (get_instance_id(), time.time(), prompt_id, previous_owner),
+        rowcount=True
+    ) == 1
+
+def journal_update(prompt_id, status, result=None):
+    """Sets a journaled prompt's status ('completed', 'failed' or 'lost') and optional result."""
+    journal_execute(
+        "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE prompt_id = ?",
+        (status, json.dumps(result) if result is not None else None, time.time(), prompt_id)
+    )
+
+def journal_get(prompt_id):
+    """Returns a journaled prompt's entry as a dict, or None if it isn't journaled."""
+    rows = journal_execute(
+        "SELECT status, bindings, result, created_at, updated_at FROM jobs WHERE prompt_id = ?", (prompt_id,)
+    )
+    if not rows:
+        return None
+    status, bindings, result, created_at, updated_at = rows[0]
+    return {
+        "prompt_id": prompt_id,
+        "status": status,
+        "bindings": json.loads(bindings or '{}'),
+        "result": json.loads(result) if result is not None else None,
+        "created_at": created_at,
+        "updated_at": updated_at
+    }
+
+def get_queue():
+    """Retrieves ComfyUI's running and pending queue."""
+    try:
+        with urllib.request.urlopen(f"{COMFYUI_URL}/queue") as response:
+            return json.loads(response.read())
+    except Exception as e:
+        print(f"Error fetching queue: {e}")
+        return None
+
+def get_prompt_state(prompt_id):
+    """
+    Asks ComfyUI where a prompt stands.
+
+    Returns:
+        str: 'finished' if it is in /history, 'queued' if it is queued or running, else None.
+
+    Raises:
+        ConnectionError: If ComfyUI can't be asked (the prompt's fate is unknown).
+    """
+    history = get_history(prompt_id)
+    if history and prompt_id in history:
+        return 'finished'
+    queue = get_queue()
+    if history is None or queue is None:
+        raise ConnectionError(f"Could not reach ComfyUI to check prompt {prompt_id}.")
+    queued_ids = {item[1] for item in queue.get('queue_running', []) + queue.get('queue_pending', [])}
+    return 'queued' if prompt_id in queued_ids else None
+
+def journal_release(prompt_id):
+    """Hands a journaled prompt back to recovery: 'queued' with no owner, so any process may claim it."""
+    journal_execute(
+        "UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE prompt_id = ? AND status IN ('queued', 'recovering')",
+        (time.time(), prompt_id)
+    )
+
+def journal_give_up(prompt_id):
+    """
+    Called when a live request stops waiting for a prompt. If ComfyUI may still produce
+    (or already has) its outputs, the entry is released to recovery instead of being written off.
+    """
+    try:
+        state = get_prompt_state(prompt_id)
+    except ConnectionError:
+        state = 'unknown' # Let recovery decide once ComfyUI answers again
+    if state is None:
+        journal_update(prompt_id, 'failed')
+    else:
+        print(f"Handing prompt {prompt_id} ({state}) to journal recovery.")
+        journal_release(prompt_id)
+
+def collect_journaled_outputs(prompt_id, client_id):
+    """
+    Collects output image bytes for a journaled prompt, waiting for as long as ComfyUI
+    still has it queued or running.
+
+    Returns:
+        dict: Output node IDs mapped to image bytes (empty if the prompt finished but its
+              images only went out over a websocket nobody was reading).
+              Returns None if neither ComfyUI's history nor its queue knows the prompt.
+
+    Raises:
+        ConnectionError: If ComfyUI stops answering.
+    """
+    state = get_prompt_state(prompt_id)
+    while state == 'queued':
+        # Reconnect with the original client ID so ComfyUI routes the prompt's messages to us
+        print(f"Recovery: prompt {prompt_id} is still in ComfyUI's queue, reattaching via websocket.")
+        ws = connect_websocket(client_id)
+        try:
+            state = get_prompt_state(prompt_id) # It may have finished while we connected
+            if state != 'queued':
+                break
+            try:
+                images = receive_images_via_websocket(ws, prompt_id, [OUTPUT_NODE_ID])
+            except websocket.WebSocketTimeoutException:
+                print(f"Recovery: no news for prompt {prompt_id} after {WEBSOCKET_TIMEOUT}s, re-checking the queue.")
+                images = {}
+            if images:
+                return images
+            state = get_prompt_state(prompt_id)
+            if images is None and state == 'queued':
+                time.sleep(1) # Websocket error: brief pause before reconnecting
+        finally:
+            try: ws.close()
+            except Exception as close_err: print(f"Error closing websocket: {close_err}")
+    if state is None:
+        return None
+    return fetch_outputs_from_history(prompt_id)
+
+def recover_job(prompt_id, client_id, bindings):
+    """Collects a journaled prompt's image into CREATIONS_DIR and finalizes its journal entry."""
+    try:
+        images = collect_journaled_outputs(prompt_id, client_id)
+    except Exception as e:
+        print(f"Recovery: error collecting prompt {prompt_id}, releasing it for a later attempt: {e}")
+        journal_release(prompt_id)
+        return
+    if images is None:
+        print(f"Recovery: ComfyUI no longer knows prompt {prompt_id}, marking as lost.")
+        journal_update(prompt_id, 'lost')
+        return
+    if not images:
+        print(f"Recovery: prompt {prompt_id} finished but its outputs are not retrievable, marking as lost.")
+        journal_update(prompt_id, 'lost')
+        return
+    try:
+        ensure_creations_directory()
+        save_path = get_unique_filename(bindings.get('input', 'recovered'))
+        with open(save_path, 'wb') as f_save:
+            f_save.write(images[OUTPUT_NODE_ID])
+        print(f"Recovery: saved prompt {prompt_id} to {save_path}")
+        journal_update(prompt_id, 'completed', save_path)
+    except Exception as e:
+        print(f"Recovery: could not save prompt {prompt_id}: {e}")
+        journal_update(prompt_id, 'failed')
+
+def heartbeat_worker():
+    """Background thread: keeps this process's journal rows from being treated as orphaned."""
+    while True:
+        time.sleep(JOURNAL_HEARTBEAT_INTERVAL)
+        journal_heartbeat()
+
+def recovery_worker():
+    """Background thread: periodically prunes the journal and recovers entries whose owning process is gone."""
+    executor = ThreadPoolExecutor(max_workers=RECOVERY_MAX_WORKERS)
+    running = []
+    while True:
+        running = [future for future in running if not future.done()]
+        free_slots = RECOVERY_MAX_WORKERS - len(running)
+        if free_slots > 0 and is_comfyui_reachable():
+            now = time.time()
+            journal_execute(
+                "DELETE FROM jobs WHERE status NOT IN ('queued', 'recovering') AND updated_at < ?",
+                (now - JOURNAL_RETENTION_DAYS * 86400,)
+            )
+            journal_execute("DELETE FROM instances WHERE heartbeat_at < ?", (now - JOURNAL_RETENTION_DAYS * 86400,))
+            # Only claim as many entries as can be reattached right away (each needs its websocket read)
+            jobs = journal_execute(
+                "SELECT prompt_id, client_id, bindings, owner FROM jobs WHERE status IN ('queued', 'recovering') "
+                "AND (owner IS NULL OR owner NOT IN (SELECT instance_id FROM instances WHERE heartbeat_at >= ?)) "
+                "ORDER BY created_at LIMIT ?",
+                (now - JOURNAL_OWNER_TIMEOUT, free_slots)
+            )
+            for prompt_id, client_id, bindings, owner in jobs:
+                if not journal_claim(prompt_id, owner):
+                    continue # Another process got there first
+                print(f"Recovery: claimed orphaned prompt {prompt_id} (previous owner: {owner or 'none'}).")
+                running.append(executor.submit(recover_job, prompt_id, client_id, json.loads(bindings or '{}')))
+        time.sleep(RECOVERY_SCAN_INTERVAL)
+
+def start_recovery():
+    """Registers this process as a journal owner and starts the heartbeat and recovery threads (no-op when disabled)."""
+    if JOURNAL_ENABLED:
+        journal_heartbeat()
+        threading.Thread(target=heartbeat_worker, name="journal-heartbeat", daemon=True).start()
+        threading.Thread(target=recovery_worker, name="journal-recovery", daemon=True).start()
+
+def get_client_key():
+    """Identifies the caller for admission control: allow-listed API key if sent, else client IP."""
+    api_key = request.headers.get(API_KEY_HEADER)
+    if api_key:
+        key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        if key_hash in API_KEY_HASHES:
+            return f"key:{key_hash[:16]}" # Hash prefix keeps raw keys out of logs
+    if TRUST_FORWARDED_FOR and request.headers.get('X-Forwarded-For'):
+        return f"ip:{request.headers['X-Forwarded-For'].split(',')[0].strip()}"
+    return f"ip:{request.remote_addr}"
+
+def try_admit(client_key, cost=1):
+    """
+    Takes `cost` tokens from the client's bucket and reserves a concurrency slot.
+    A request costing more than the bucket holds is admitted once the bucket is full
+    and leaves it in debt, so the client waits for the full cost before its next request.
+
+    Returns:
+        tuple: (True, 0) if admitted, otherwise (False, retry_after_seconds).
+    """
+    refill_per_sec = RATE_LIMIT_PER_MINUTE / 60.0
+    now = time.monotonic()
+    with _admission_lock:
+        if len(_buckets) > MAX_TRACKED_CLIENTS:
+            for key in [k for k, (tokens, last) in _buckets.items()
+                        if not _in_flight.get(k) and tokens + (now - last) * refill_per_sec >= RATE_LIMIT_BURST]:
+                del _buckets[key]
+
+        tokens, last = _buckets.get(client_key, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * refill_per_sec)
+
+        if _in_flight.get(client_key, 0) >= MAX_CONCURRENT_PER_CLIENT:
+            _buckets[client_key] = (tokens, now)
+            return False, 1
+        required = min(cost, RATE_LIMIT_BURST) # Tokens needed up front; the rest of the cost becomes debt
+        if tokens < required:
+            _buckets[client_key] = (tokens, now)
+            return False, max(1, math.ceil((required - tokens) / refill_per_sec))
+
+        _buckets[client_key] = (tokens - cost, now)
+        _in_flight[client_key] = _in_flight.get(client_key, 0) + 1
+        return True, 0
+
+def release(client_key):
+    """Frees the concurrency slot reserved by try_admit."""
+    with _admission_lock:
+        remaining = _in_flight.get(client_key, 0) - 1
+        if remaining > 0:
+            _in_flight[client_key] = remaining
+        else:
+            _in_flight.pop(client_key, None)
+
+def rate_limited(endpoint):
+    """Route decorator: rejects over-limit clients with 429 + Retry-After before any ComfyUI work."""
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        if not RATE_LIMIT_ENABLED:
+            return endpoint(*args, **kwargs)
+        client_key = get_client_key()
+        admitted, retry_after = try_admit(client_key)
+        if not admitted:
+            print(f"Rate limit: rejected request from {client_key} (retry after {retry_after}s)")
+            response = jsonify({"error": "Too many requests. Please retry later.", "retry_after": retry_after})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            release(client_key)
+    return wrapper
+
+def start_background_tasks():
+    """Starts warm-up and journal recovery, once per serving process."""
+    global _background_tasks_started
+    with _background_tasks_lock:
+        if _background_tasks_started:
+            return
+        _background_tasks_started = True
+    start_warmup()
+    start_recovery()
+
+@app.before_request
+def ensure_background_tasks():
+    # Covers servers that import the app instead of running this script (flask run, gunicorn, waitress):
+    # the first request, typically the /ready probe, starts warm-up in the process that actually serves.
+    start_background_tasks()
+
+@app.route('/ready', methods=['GET'])
+def readiness_endpoint():
+    """Readiness probe: 200 only once warm-up has finished and ComfyUI is reachable."""
+    comfyui_reachable = is_comfyui_reachable()
+    ready = comfyui_reachable and _warmup_state["done"]
+    body = {
+        "ready": ready,
+        "comfyui_reachable": comfyui_reachable,
+        "warmed_up": _warmup_state["done"],
+        "warmup_error": _warmup_state["error"]
+    }
+    return jsonify(body), 200 if ready else 503
+
 @app.route('/generate', methods=['POST'])
+@rate_limited
 def generate_image_endpoint():
     """Flask endpoint to generate an image based on input prompt."""
     data = request.json
@@ -192,7 +855,19 @@ def generate_image_endpoint():
     if not isinstance(input_prompt, str) or not input_prompt.strip():
          return jsonify({"error": "'input' must be a non-empty string"}), 400
 
-    print(f"Received prompt: {input_prompt}")
+    mode = data.get('mode', 'full')
+    if mode not in GENERATION_MODES:
+        return jsonify({"error": f"'mode' must be one of {list(GENERATION_MODES)}"}), 400
+
+    seed = data.get('seed')
+    if isinstance(seed, str) and seed.isascii() and seed.isdigit():
+        seed = int(seed) # Allow string seeds: 64-bit values don't survive a JS number round trip
+    if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed <= 0xffffffffffffffff):
+        return jsonify({"error": "'seed' must be a non-negative 64-bit integer"}), 400
+    if mode == "refine" and seed is None:
+        return jsonify({"error": "'seed' is required for 'refine' mode (use the X-Seed header of the preview response)"}), 400
+
+    print(f"Received prompt: {input_prompt} (mode: {mode})")
 
     # --- Load Workflow ---
     try:
@@ -232,8 +907,8 @@ def generate_image_endpoint():
     except Exception as e: # Catch any unexpected modification errors
         print(f"Error modifying workflow node {PROMPT_NODE_ID}: {e}")
         return jsonify({"error": "Failed to modify workflow with the new prompt."}), 500
-  # --- *** ADD THIS SECTION TO RANDOMIZE SEED *** ---
-    KSAMPLER_NODE_ID = "4" # <--- Add this near your other config variables
+
+    # --- Seed ---
     if KSAMPLER_NODE_ID not in workflow:
         print(f"Error: KSampler node ID '{KSAMPLER_NODE_ID}' not found in workflow keys.")
         print(f"Available node IDs: {list(workflow.keys())}")
@@ -246,55 +921,83 @@ def generate_image_endpoint():
          return jsonify({"error": f"Workflow structure error: Cannot find 'inputs.seed' in node {KSAMPLER_NODE_ID}."}), 500
 
     try:
-        # Generate a random seed (ComfyUI uses large integers)
-        new_seed = random.randint(0, 0xffffffffffffffff) # Generates a 64-bit integer
-        workflow[KSAMPLER_NODE_ID]['inputs']['seed'] = new_seed
-        print(f"Set random seed in node {KSAMPLER_NODE_ID} to: {new_seed}")
+        if seed is None:
+            # Generate a random seed (ComfyUI uses large integers)
+            seed = random.randint(0, 0xffffffffffffffff) # Generates a 64-bit integer
+        workflow[KSAMPLER_NODE_ID]['inputs']['seed'] = seed
+        print(f"Set seed in node {KSAMPLER_NODE_ID} to: {seed}")
     except Exception as e:
         print(f"Error modifying seed in workflow node {KSAMPLER_NODE_ID}: {e}")
-        return jsonify({"error": "Failed to set random seed in workflow."}), 500
-    # --- *** END OF ADDED SECTION *** ---
+        return jsonify({"error": "Failed to set seed in workflow."}), 500
 
-    # --- Queue Prompt ---
-    # Use the persistent CLIENT_ID
-    queue_response = queue_prompt(workflow, CLIENT_ID)
+    # --- Preview / Refine ---
+    if mode != "full":
+        if LATENT_NODE_ID not in workflow or 'width' not in workflow[LATENT_NODE_ID].get('inputs', {}):
+            print(f"Error: Latent node ID '{LATENT_NODE_ID}' not found or missing 'inputs.width'.")
+            return jsonify({"error": f"Workflow structure error: Cannot find 'inputs.width' in node {LATENT_NODE_ID}."}), 500
+        try:
+            if mode == "preview":
+                apply_preview_settings(workflow)
+            else:
+                apply_refine_settings(workflow)
+            print(f"Applied '{mode}' settings to workflow.")
+        except Exception as e:
+            print(f"Error applying '{mode}' settings to workflow: {e}")
+            return jsonify({"error": f"Failed to prepare workflow for '{mode}' mode."}), 500
 
-    if not queue_response or 'prompt_id' not in queue_response:
-        print("Error: Failed to queue prompt. Queue response:", queue_response)
-        return jsonify({"error": "Failed to queue prompt with ComfyUI. Check ComfyUI connection and logs."}), 500
+    bindings = {"input": input_prompt, "seed": seed, "mode": mode}
+    if USE_WEBSOCKET_IMAGES:
+        prompt_id, image_data, ws_error = generate_via_websocket(workflow, bindings)
+        if ws_error:
+            if prompt_id:
+                journal_give_up(prompt_id)
+            return jsonify({"error": ws_error, "prompt_id": prompt_id}), 500
+    else:
+        # --- Queue Prompt ---
+        # Use the persistent CLIENT_ID
+        queue_response = queue_prompt(workflow, CLIENT_ID)
 
-    prompt_id = queue_response['prompt_id']
-    print(f"Prompt queued successfully. Prompt ID: {prompt_id} (Client ID: {CLIENT_ID})")
+        if not queue_response or 'prompt_id' not in queue_response:
+            print("Error: Failed to queue prompt. Queue response:", queue_response)
+            return jsonify({"error": "Failed to queue prompt with ComfyUI. Check ComfyUI connection and logs."}), 500
 
-    # --- Wait for Image using Polling ---
-    output_details_dict = wait_for_output_and_get_details(prompt_id, OUTPUT_NODE_ID) # Pass single ID
+        prompt_id = queue_response['prompt_id']
+        print(f"Prompt queued successfully. Prompt ID: {prompt_id} (Client ID: {CLIENT_ID})")
+        journal_record(prompt_id, CLIENT_ID, bindings)
 
-    # --- Process Polling Result ---
-    if output_details_dict is None: # Indicates connection error during polling
-         print(f"Error: Connection error while polling history for prompt_id {prompt_id}.")
-         return jsonify({"error": "Failed to get generated image details (history connection error)."}), 500
+        # --- Wait for Image using Polling ---
+        output_details_dict = wait_for_output_and_get_details(prompt_id, OUTPUT_NODE_ID) # Pass single ID
 
-    if OUTPUT_NODE_ID not in output_details_dict or "filename" not in output_details_dict.get(OUTPUT_NODE_ID, {}):
-        error_detail = output_details_dict.get(OUTPUT_NODE_ID, {}).get("error", "Output not found in history.")
-        print(f"Error: Could not retrieve image details via history polling for prompt_id {prompt_id}. Error: {error_detail}")
-        return jsonify({"error": f"Failed to get generated image details from ComfyUI. Reason: {error_detail}"}), 500
+        # --- Process Polling Result ---
+        if output_details_dict is None: # Indicates connection error during polling
+             print(f"Error: Connection error while polling history for prompt_id {prompt_id}.")
+             journal_give_up(prompt_id)
+             return jsonify({"error": "Failed to get generated image details (history connection error).", "prompt_id": prompt_id}), 500
 
-    output_details = output_details_dict[OUTPUT_NODE_ID]
-    filename = output_details['filename']
-    subfolder = output_details['subfolder']
-    folder_type = output_details['type']
+        if OUTPUT_NODE_ID not in output_details_dict or "filename" not in output_details_dict.get(OUTPUT_NODE_ID, {}):
+            error_detail = output_details_dict.get(OUTPUT_NODE_ID, {}).get("error", "Output not found in history.")
+            print(f"Error: Could not retrieve image details via history polling for prompt_id {prompt_id}. Error: {error_detail}")
+            journal_give_up(prompt_id)
+            return jsonify({"error": f"Failed to get generated image details from ComfyUI. Reason: {error_detail}", "prompt_id": prompt_id}), 500
 
-    # --- Fetch Image Data ---
-    print(f"Fetching image: filename={filename}, subfolder={subfolder}, type={folder_type}")
-    image_data = get_image_data(filename, subfolder, folder_type)
+        output_details = output_details_dict[OUTPUT_NODE_ID]
+        filename = output_details['filename']
+        subfolder = output_details['subfolder']
+        folder_type = output_details['type']
 
-    if not image_data:
-        print("Error: Failed to fetch image data after getting filename.")
-        return jsonify({"error": "Failed to fetch image data from ComfyUI even though filename was found."}), 500
+        # --- Fetch Image Data ---
+        print(f"Fetching image: filename={filename}, subfolder={subfolder}, type={folder_type}")
+        image_data = get_image_data(filename, subfolder, folder_type)
+
+        if not image_data:
+            print("Error: Failed to fetch image data after getting filename.")
+            journal_give_up(prompt_id)
+            return jsonify({"error": "Failed to fetch image data from ComfyUI even though filename was found.", "prompt_id": prompt_id}), 500
 
     print(f"Image data fetched successfully ({len(image_data)} bytes).")
 
     # --- Save Image Locally (Optional but Recommended) ---
+    save_path = None
     try:
         ensure_creations_directory()
         save_path = get_unique_filename(input_prompt)
@@ -304,15 +1007,47 @@ def generate_image_endpoint():
     except Exception as e:
         # Log the warning but don't fail the request if saving fails
         print(f"Warning: Could not save image locally to {CREATIONS_DIR}: {e}")
+    journal_update(prompt_id, 'completed', save_path)
 
     # --- Return Image ---
     print("Sending image data in response.")
-    return send_file(
+    response = send_file(
         io.BytesIO(image_data),
         mimetype='image/png',
         as_attachment=False # Send inline in browser
         # download_name=f"{prompt_id}_{filename}" # Optional: suggest a download name
     )
+    # Clients pass this seed back with mode "refine" to get the full-quality version of a preview
+    response.headers['X-Seed'] = str(seed)
+    response.headers['X-Generation-Mode'] = mode
+    # Lets clients pick up the result via /jobs/<prompt_id> if this response is lost
+    response.headers['X-Prompt-Id'] = prompt_id
+    return response
+
+@app.route('/jobs/<prompt_id>', methods=['GET'])
+@rate_limited
+def job_status_endpoint(prompt_id):
+    """
+    Looks up a journaled prompt (e.g. one whose /generate request failed or timed out).
+    Completed jobs return the saved image, anything else returns the journal entry as JSON.
+    """
+    if not JOURNAL_ENABLED:
+        return jsonify({"error": "The job journal is disabled on this server."}), 404
+    job = journal_get(prompt_id)
+    if job is None:
+        return jsonify({"error": f"Unknown prompt_id '{prompt_id}'."}), 404
+    save_path = job.pop("result") # Server-side path, not exposed to clients
+    if job["status"] == 'completed' and save_path and os.path.isfile(save_path):
+        response = send_file(save_path, mimetype='image/png', as_attachment=False)
+        response.headers['X-Prompt-Id'] = prompt_id
+        if job["bindings"].get("seed") is not None:
+            response.headers['X-Seed'] = str(job["bindings"]["seed"])
+        if job["bindings"].get("mode"):
+            response.headers['X-Generation-Mode'] = job["bindings"]["mode"]
+        return response
+    if job["status"] == 'completed':
+        job["error"] = "The image was generated but is no longer available on this server."
+    return jsonify(job), 200
 
 if __name__ == "__main__":
     print("--- Flask ComfyUI API Server ---")
@@ -321,6 +1056,11 @@ if __name__ == "__main__":
     print(f"Workflow File Path: {WORKFLOW_FILE_PATH}")
     print(f"Prompt Node ID: {PROMPT_NODE_ID}")
     print(f"Output Node ID: {OUTPUT_NODE_ID}")
+    print(f"Rate limit: {RATE_LIMIT_PER_MINUTE}/min, burst {RATE_LIMIT_BURST}, max concurrent {MAX_CONCURRENT_PER_CLIENT} per client" if RATE_LIMIT_ENABLED else "Rate limit: disabled")
+    print(f"Warm-up on startup: {WARMUP_ON_STARTUP}")
+    print(f"Job journal: {JOURNAL_PATH if JOURNAL_ENABLED else 'disabled'}")
+    print(f"Image delivery: {'websocket (' + WEBSOCKET_OUTPUT_CLASS + ')' if USE_WEBSOCKET_IMAGES else '/view fetch'}")
+    print(f"Preview: {PREVIEW_WIDTH}x{PREVIEW_HEIGHT} @ {PREVIEW_STEPS} steps, refine denoise: {REFINE_DENOISE}")
     print(f"Saving images to: {CREATIONS_DIR}")
     print(f"Using Client ID: {CLIENT_ID}") # Log the client ID being used
 
@@ -334,7 +1074,10 @@ if __name__ == "__main__":
 
     ensure_creations_directory() # Ensure directory exists at startup
 
+    # Warm up / recover right away in the serving process (the debug reloader's parent process never serves requests)
+    if not FLASK_DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_tasks()
+
     print("\nStarting Flask server...")
     # Make sure host='0.0.0.0' is used if you want to access it from other machines on your network
-    # Use debug=False in a production environment
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=FLASK_DEBUG)
\ No newline at end of file